@@ -7,8 +7,12 @@
 from __future__ import print_function
 
 import contextlib
+import errno
+import glob
+import hashlib
+import multiprocessing
 import os
-import re
+import signal
 import subprocess
 import tempfile
 import time
@@ -19,53 +23,258 @@ from chromite.cbuildbot.stages import generic_stages
 from chromite.cbuildbot.stages import sync_stages
 from chromite.lib import cros_build_lib
 from chromite.lib import cros_logging as logging
+from chromite.lib import locking
 from chromite.lib import osutils
+from chromite.lib import timeout_util
+
+
+# ccache binary shipped in the Brillo checkout, relative to BrilloRoot().
+CCACHE = 'prebuilts/misc/linux-x86/ccache/ccache'
+
+# How much of the end of the emulator output to include in the build log.
+EMULATOR_LOG_TAIL_BYTES = 64 * 1024
+
+# Read size used when pulling files into the page cache.
+PREFETCH_CHUNK_BYTES = 1024 * 1024
+
+# Fields of the build config which determine what ends up in out/.
+FINGERPRINT_FIELDS = ('brillo_manifest_url', 'brillo_manifest_branch',
+                      'lunch_target')
 
 
 class EmulatorFailedToStart(Exception):
-  """The emulator process isn't running after 10 seconds."""
+  """The emulator process isn't running shortly after being started."""
 
 
 class EmulatorNotReady(Exception):
   """The adb devices command did not discover a valid emulator serial number."""
 
 
+def _SnapshotCompressors():
+  """Returns (extension, tar compress program) pairs for checkout snapshots.
+
+  The list is in order of preference, and only includes available programs.
+  All of them use multiple cores, since snapshots are many GB.
+  """
+  compressors = []
+  if osutils.Which('zstd'):
+    compressors.append(('.zst', 'zstd -T0 --long=27'))
+  # Uses pigz, if it's installed.
+  compressors.append(
+      ('.gz', cros_build_lib.FindCompressor(cros_build_lib.COMP_GZIP)))
+  return compressors
+
+
+def _RmDirInBackground(path, trash_dir):
+  """Remove a directory tree, without waiting for the deletion to finish.
+
+  The tree is moved into trash_dir, which is quick, and everything in
+  trash_dir is then removed by a detached rm process. This also picks up
+  leftovers from earlier removals which were interrupted.
+
+  Args:
+    path: Directory to remove. It's fine if it doesn't exist.
+    trash_dir: Directory to move path into. It must be on the same filesystem
+      as path, and outside any tree we tar up or sync into.
+  """
+  osutils.SafeMakedirs(trash_dir)
+  victim = os.path.join(trash_dir, '%s-%d-%d' % (
+      os.path.basename(path), os.getpid(), time.time()))
+  try:
+    os.rename(path, victim)
+  except OSError as e:
+    if e.errno == errno.EXDEV:
+      # Can't move it; delete it the slow way.
+      osutils.RmDir(path, ignore_missing=True)
+    elif e.errno != errno.ENOENT:
+      raise
+
+  victims = glob.glob(os.path.join(trash_dir, '*'))
+  if not victims:
+    return
+
+  # The unlink storm competes with sync and build for disk, so run it at the
+  # lowest best-effort priority. Not the idle class, which a busy build can
+  # starve, leaving the old tree taking up disk indefinitely.
+  cmd = ['nice', '-n', '19', 'rm', '-rf'] + victims
+  if osutils.Which('ionice'):
+    cmd = ['ionice', '-c', '2', '-n', '7'] + cmd
+  subprocess.Popen(cmd, close_fds=True, preexec_fn=os.setsid)
+
+
+def _PrefetchFiles(paths):
+  """Read files into the page cache.
+
+  This is only an optimization, so files which can't be read are skipped.
+
+  Args:
+    paths: List of files to read.
+  """
+  for path in paths:
+    try:
+      with open(path, 'rb') as f:
+        # Large sequential reads are much quicker than the scattered page
+        # faults a later reader would otherwise take.
+        while f.read(PREFETCH_CHUNK_BYTES):
+          pass
+    except EnvironmentError as e:
+      logging.warning('Unable to prefetch %s: %s', path, e)
+
+
+def _KillProcessGroup(proc, timeout=30):
+  """Kill a process started as a process group leader, and its whole group.
+
+  Args:
+    proc: subprocess.Popen object, started with preexec_fn=os.setsid.
+    timeout: Seconds to wait after SIGTERM, before falling back to SIGKILL.
+  """
+  def _SignalGroup(sig):
+    """Send sig to the group, returning False if the group is gone."""
+    try:
+      os.killpg(proc.pid, sig)
+    except OSError as e:
+      if e.errno != errno.ESRCH:
+        raise
+      return False
+    return True
+
+  # Wait for every process in the group, not just the leader: the leader may
+  # be a shell which exits at SIGTERM while the emulator it started is still
+  # shutting down.
+  _SignalGroup(signal.SIGTERM)
+  for _ in xrange(timeout * 10):
+    # Reap the leader, so it doesn't keep the group alive as a zombie.
+    proc.poll()
+    if not _SignalGroup(0):
+      break
+    time.sleep(0.1)
+
+  # Catch anything which ignored SIGTERM.
+  _SignalGroup(signal.SIGKILL)
+  proc.wait()
+
+
 class BrilloStageBase(generic_stages.BuilderStage):
   """Base class for all symbols build stages."""
 
-  def BrilloRoot(self):
-    """Root for repo checkout of Brillo."""
+  def __init__(self, builder_run, **kwargs):
+    super(BrilloStageBase, self).__init__(builder_run, **kwargs)
+
+    # These are used by nearly every command we run, and don't change for the
+    # life of the stage, so only work them out once.
+
     # Turn /mnt/data/b/cbuild/android -> /mnt/data/b/cbuild/android_brillo
 
     # We have to be OUTSIDE the build root, since this is a new repo checkout.
     # We don't want to be in /tmp both because we might not fit, and because the
     # initial sync is expensive enough that we don't want to have to redo it if
     # avoidable.
-    return self._run.buildroot + '_brillo'
+    self._brillo_root = self._run.buildroot + '_brillo'
+    self._build_output = os.path.join(self._brillo_root, 'out')
+
+    # Only the setup output is discarded, not that of the command.
+    self._lunch_prefix = (
+        '{ export USE_CCACHE=1 CCACHE_DIR=%s && . build/envsetup.sh && '
+        'lunch %s; } > /dev/null && OUT_DIR=%s ' % (
+            self.CcacheDir(), self._run.config.lunch_target,
+            self._build_output))
+
+    self._lunch_env = None
+
+  def BrilloRoot(self):
+    """Root for repo checkout of Brillo."""
+    return self._brillo_root
 
   def BuildOutput(self):
     """Returns directory for brillo build output."""
-    return os.path.join(self.BrilloRoot(), 'out')
+    return self._build_output
+
+  def FingerprintFile(self):
+    """Returns the file recording what the build output was built for."""
+    return os.path.join(self.BuildOutput(), '.brillo_fingerprint')
+
+  def BuildFingerprint(self):
+    """Returns a string describing what the build output is built for."""
+    return ''.join('%s=%s\n' % (field, self._run.config[field])
+                   for field in FINGERPRINT_FIELDS)
+
+  def MirrorRoot(self):
+    """Root for the bare mirror of Brillo, shared by all local checkouts."""
+    # Turn /mnt/data/b/cbuild/android -> /mnt/data/b/cbuild/brillo_mirror
+
+    # Every buildroot on the builder references the same mirror, so a checkout
+    # of another branch only fetches what the mirror doesn't already have.
+    return os.path.join(os.path.dirname(self._run.buildroot), 'brillo_mirror')
+
+  def TrashDir(self):
+    """Returns directory for trees waiting to be deleted in the background."""
+    # Beside BrilloRoot() (so on the same filesystem), but outside it, so
+    # nothing syncs into or snapshots a tree while it's being deleted.
+    return self._run.buildroot + '_brillo_trash'
+
+  def CcacheDir(self):
+    """Returns directory for the compiler cache shared between builds."""
+    # Kept beside (not inside) BrilloRoot(), so it survives a clobber.
+    return self._run.buildroot + '_brillo_ccache'
+
+  def SyncJobs(self):
+    """Returns the number of parallel fetches to use for repo sync."""
+    # Sync time is dominated by per-project network latency, not CPU, so we
+    # default to more jobs than we have cores.
+    return self._run.config.brillo_sync_jobs or multiprocessing.cpu_count() * 2
+
+  def SnapshotPath(self):
+    """Returns the checkout snapshot path, minus compression extension.
+
+    Returns:
+      The path, or None if snapshots are disabled.
+    """
+    snapshot_dir = self._run.config.brillo_snapshot_dir
+    if not snapshot_dir:
+      return None
+
+    # Key the snapshot on what is checked out, so different builders sharing
+    # the cache directory don't restore each other's trees.
+    key = hashlib.md5('%s:%s' % (self._run.config.brillo_manifest_url,
+                                 self._run.config.brillo_manifest_branch))
+    return os.path.join(snapshot_dir,
+                        'brillo_snapshot.%s.tar' % key.hexdigest())
 
   def FindShellCmd(self, cmd):
-    target = self._run.config.lunch_target
+    """Returns a shell command line which runs cmd after lunch setup."""
+    return self._lunch_prefix + ' '.join(cmd)
 
-    cmd_list = []
-    cmd_list.append('. build/envsetup.sh')
-    cmd_list.append('lunch %s' % target)
-    cmd_list.append('OUT_DIR=%s' % self.BuildOutput())
-    cmd_list.append(' '.join(cmd))
+  def _GetLunchEnv(self):
+    """Returns the environment set up by envsetup.sh and lunch.
+
+    Sourcing envsetup.sh and running lunch takes several seconds, so we only
+    do it once per stage, and run later commands in the resulting environment.
+    """
+    if self._lunch_env is None:
+      result = cros_build_lib.RunCommand(
+          self.FindShellCmd(['env', '-0']), shell=True, cwd=self.BrilloRoot(),
+          redirect_stdout=True)
+      self._lunch_env = dict(var.split('=', 1)
+                             for var in result.output.split('\0') if var)
 
-    return ' > /dev/null && '.join(cmd_list)
+    return self._lunch_env
 
   def RunLunchCommand(self, cmd, **kwargs):
     """RunCommand with lunch setup."""
     # Default directory to run in.
     kwargs.setdefault('cwd', self.BrilloRoot())
 
-    # We use a shell invocation so environmental variables are preserved.
-    cmd = self.FindShellCmd(cmd)
-    return cros_build_lib.RunCommand(cmd, shell=True, **kwargs)
+    # We use a shell invocation so commands behave as they would after lunch.
+    return cros_build_lib.RunCommand(' '.join(cmd), shell=True,
+                                     env=self._GetLunchEnv(), **kwargs)
+
+  def RunLunchCommandNoShell(self, cmd, **kwargs):
+    """RunCommand with lunch setup, exec'ing cmd directly without a shell."""
+    # Default directory to run in.
+    kwargs.setdefault('cwd', self.BrilloRoot())
+
+    # The lunch environment provides PATH, so cmd[0] is resolved against it.
+    return cros_build_lib.RunCommand(cmd, env=self._GetLunchEnv(), **kwargs)
 
 
 class BrilloCleanStage(BrilloStageBase):
@@ -73,24 +282,132 @@ class BrilloCleanStage(BrilloStageBase):
 
   def PerformStage(self):
     """Clean up Brillo build output."""
-    osutils.RmDir(self.BuildOutput(), ignore_missing=True)
-
     if self._run.options.clobber:
+      _RmDirInBackground(self.BrilloRoot(), self.TrashDir())
+      return
+
+    # Otherwise we rely on incremental builds, unless the output directory was
+    # built for a different branch or target. BrilloBuildStage writes the
+    # fingerprint once a build succeeds.
+    if not os.path.exists(self.BuildOutput()):
+      return
+
+    fingerprint_file = self.FingerprintFile()
+    if (not os.path.exists(fingerprint_file) or
+        osutils.ReadFile(fingerprint_file) != self.BuildFingerprint()):
+      logging.info('Build output is stale, removing it.')
+      _RmDirInBackground(self.BuildOutput(), self.TrashDir())
+
+
+class BrilloSnapshotRestoreStage(BrilloStageBase):
+  """Seed an empty Brillo checkout from a cached snapshot."""
+
+  def PerformStage(self):
+    """Unpack the snapshot, if we have one and no existing checkout."""
+    snapshot = self.SnapshotPath()
+    if snapshot:
+      for ext, compressor in _SnapshotCompressors():
+        if os.path.exists(snapshot + ext):
+          snapshot += ext
+          break
+      else:
+        snapshot = None
+
+    if not snapshot:
+      logging.info('No Brillo checkout snapshot available.')
+      return
+
+    if os.path.exists(os.path.join(self.BrilloRoot(), '.repo')):
+      logging.info('Brillo checkout already exists, not restoring snapshot.')
+      return
+
+    logging.info('Restoring Brillo checkout from %s', snapshot)
+    osutils.SafeMakedirs(self.BrilloRoot())
+    try:
+      cros_build_lib.RunCommand(['tar', '-I', compressor, '-xf', snapshot],
+                                cwd=self.BrilloRoot())
+    except cros_build_lib.RunCommandError:
+      # A partial tree is worse than none; let the sync start from scratch.
+      logging.warning('Failed to restore snapshot, doing a full sync.')
       osutils.RmDir(self.BrilloRoot(), ignore_missing=True)
 
 
+class BrilloSnapshotSaveStage(BrilloStageBase):
+  """Cache a snapshot of the freshly synced Brillo checkout."""
+
+  def PerformStage(self):
+    """Tar up the checkout (minus build output) into the snapshot cache."""
+    snapshot = self.SnapshotPath()
+    if not snapshot:
+      logging.warning('brillo_snapshot_dir is not set, not saving a snapshot.')
+      return
+
+    osutils.SafeMakedirs(os.path.dirname(snapshot))
+
+    compressors = _SnapshotCompressors()
+    ext, compressor = compressors[0]
+
+    # Write to a temp file and rename, so restores never see a partial file.
+    tmp_snapshot = snapshot + ext + '.tmp'
+    cros_build_lib.RunCommand(
+        ['tar', '-I', compressor, '-cf', tmp_snapshot, '--exclude=./out', '.'],
+        cwd=self.BrilloRoot())
+    os.rename(tmp_snapshot, snapshot + ext)
+
+    # Don't leave older snapshots around for the restore to pick up instead.
+    for other_ext, _ in compressors[1:]:
+      osutils.SafeUnlink(snapshot + other_ext)
+
+
+class BrilloMirrorSyncStage(BrilloStageBase):
+  """Create or update the shared mirror referenced by the Brillo checkout."""
+
+  def PerformStage(self):
+    """Fetch new objects into the mirror."""
+    osutils.SafeMakedirs(self.MirrorRoot())
+
+    # Other buildroots on this builder may be updating the mirror too.
+    lock = locking.FileLock(self.MirrorRoot() + '.lock', 'brillo mirror')
+    with lock.write_lock():
+      mirror_repo = repository.RepoRepository(
+          manifest_repo_url=self._run.config.brillo_manifest_url,
+          branch=self._run.config.brillo_manifest_branch,
+          directory=self.MirrorRoot())
+      mirror_repo.Initialize(extra_args=['--mirror'])
+      mirror_repo.Sync(jobs=self.SyncJobs(), network_only=True)
+
+
 class BrilloSyncStage(BrilloStageBase):
   """Sync Brillo code to a sub-directory."""
 
+  def SyncDepth(self):
+    """Returns the history depth for the checkout, or None for full history."""
+    # Only limit history on a fresh checkout (first sync, or after a clobber).
+    # Warm checkouts keep whatever history they already have.
+    if os.path.exists(os.path.join(self.BrilloRoot(), '.repo')):
+      return None
+    return self._run.config.brillo_sync_depth
+
   def PerformStage(self):
     """Fetch and/or update the brillo source code."""
+    # Fetching objects through a local mirror makes a shallow clone pointless
+    # (and repo doesn't allow both), so enabling brillo_reference_mirror
+    # disables brillo_sync_depth. The mirror holds full history of every
+    # branch, so it's only worth it on builders which sync several branches.
+    if self._run.config.brillo_reference_mirror:
+      referenced_repo, depth = self.MirrorRoot(), None
+    else:
+      referenced_repo, depth = None, self.SyncDepth()
+
     osutils.SafeMakedirs(self.BrilloRoot())
     brillo_repo = repository.RepoRepository(
         manifest_repo_url=self._run.config.brillo_manifest_url,
         branch=self._run.config.brillo_manifest_branch,
-        directory=self.BrilloRoot())
+        directory=self.BrilloRoot(),
+        referenced_repo=referenced_repo,
+        depth=depth)
     brillo_repo.Initialize()
-    brillo_repo.Sync()
+    brillo_repo.Sync(jobs=self.SyncJobs(), all_branches=False)
 
     logging.info('Syncd manifest:\n%s', brillo_repo.ExportManifest())
 
@@ -98,50 +415,144 @@ class BrilloSyncStage(BrilloStageBase):
 class BrilloBuildStage(BrilloStageBase):
   """Compile the Brillo checkout."""
 
+  def BuildJobs(self):
+    """Returns the number of parallel make jobs to use."""
+    jobs = self._run.config.brillo_build_jobs
+    if jobs in (None, 'AUTO'):
+      return multiprocessing.cpu_count()
+    return int(jobs)
+
   def PerformStage(self):
     """Do the build work."""
-    self.RunLunchCommand(['make', '-j', '32'])
+    self.RunLunchCommandNoShell(
+        [CCACHE, '-M', self._run.config.brillo_ccache_size],
+        error_code_ok=True)
+
+    # Cap the load average as well, so we don't oversubscribe the builder.
+    jobs = str(self.BuildJobs())
+    try:
+      self.RunLunchCommand(['make', '-j', jobs, '-l', jobs])
+    finally:
+      # Log the cache hit rate.
+      self.RunLunchCommandNoShell([CCACHE, '-s'], error_code_ok=True)
+
+    # Record what out/ now holds, so the next build can reuse it.
+    osutils.WriteFile(self.FingerprintFile(), self.BuildFingerprint())
 
 
 class BrilloVmTestStage(BrilloStageBase):
   """Compile the Brillo checkout."""
 
+  def EmulatorSnapshotDir(self):
+    """Returns where the configured emulator snapshot lives, or None.
+
+    Snapshots are only used if both the snapshot name and the name of the AVD
+    the emulator boots are configured.
+    """
+    avd = self._run.config.emulator_avd_name
+    snapshot = self._run.config.emulator_snapshot_name
+    if not (avd and snapshot):
+      return None
+    return os.path.expanduser(
+        '~/.android/avd/%s.avd/snapshots/%s' % (avd, snapshot))
+
+  def EmulatorSnapshotSaved(self):
+    """Returns True if the configured emulator snapshot exists."""
+    snapshot_dir = self.EmulatorSnapshotDir()
+    return bool(snapshot_dir and os.path.exists(snapshot_dir))
+
+  def EmulatorCmd(self):
+    """Returns the emulator command line, including snapshot arguments."""
+    cmd = [self._run.config.emulator]
+    if not self.EmulatorSnapshotDir():
+      return cmd
+
+    snapshot = self._run.config.emulator_snapshot_name
+
+    # Never save on exit, since by then the tests have dirtied the emulator.
+    # A cold boot saves the snapshot explicitly; see SaveEmulatorSnapshot.
+    cmd += ['-snapshot', snapshot, '-no-snapshot-save']
+    if not self.EmulatorSnapshotSaved():
+      cmd.append('-no-snapshot-load')
+    return cmd
+
+  def SaveEmulatorSnapshot(self, serial):
+    """Once the emulator has finished booting, save its state as a snapshot.
+
+    Args:
+      serial: Serial number of the running emulator.
+    """
+    # Check often, so the snapshot is taken soon after boot; but give up after
+    # several minutes.
+    for _ in xrange(300):
+      result = self.RunLunchCommandNoShell(
+          ['adb', '-s', serial, 'shell', 'getprop', 'sys.boot_completed'],
+          redirect_stdout=True,
+          combine_stdout_stderr=True,
+          error_code_ok=True)
+      if result.output.strip() == '1':
+        break
+      time.sleep(1)
+    else:
+      logging.warning('Emulator never finished booting, not saving snapshot.')
+      return
+
+    logging.info('Saving emulator snapshot.')
+    self.RunLunchCommandNoShell(
+        ['adb', '-s', serial, 'emu', 'avd', 'snapshot', 'save',
+         self._run.config.emulator_snapshot_name],
+        error_code_ok=True)
+
   @contextlib.contextmanager
   def RunEmulator(self):
     """Run an emulator process in the background, kill it on exit."""
+    # Restoring a snapshot is much quicker than a full boot.
+    snapshot_saved = self.EmulatorSnapshotSaved()
+    startup_delay = 2 if snapshot_saved else 10
+
+    # Get the disk images into memory before a full boot, rather than faulting
+    # them in as it goes. Not worth the wait when resuming a snapshot.
+    product_out = self._GetLunchEnv().get('ANDROID_PRODUCT_OUT')
+    if product_out and not snapshot_saved:
+      _PrefetchFiles(glob.glob(os.path.join(product_out, '*.img')))
+
     with tempfile.NamedTemporaryFile(prefix='emulator') as logfile:
-      cmd = ['/bin/bash', '-c', self.FindShellCmd([self._run.config.emulator])]
+      cmd = ['/bin/bash', '-c', self.FindShellCmd(self.EmulatorCmd())]
       logging.info('Starting emulator: %s', cmd)
+      # Start a new process group, so we can kill the emulator itself and not
+      # just the shell which started it.
       p = subprocess.Popen(
           args=cmd,
           close_fds=True,
           stdout=logfile,
           stderr=subprocess.STDOUT,
           cwd=self.BrilloRoot(),
+          preexec_fn=os.setsid,
           )
 
-
       try:
         # Give the emulator a little time, and make sure it's still running.
         # Failure could be an crash, another copy was left running, etc.
-        time.sleep(10)
+        time.sleep(startup_delay)
         if p.poll() is not None:
-          logging.error('Emulator is not running after 10 seconds, aborting.')
+          logging.error('Emulator is not running after %d seconds, aborting.',
+                        startup_delay)
           raise EmulatorFailedToStart()
 
         yield
       finally:
         if p.poll() is None:
-          # Kill emulator, if it's still running.
           logging.info('Stopping emulator.')
-          p.terminate()
 
-        p.wait()
+        # Kill emulator, if it's still running, along with anything it started.
+        _KillProcessGroup(p)
 
-        # Read/dump the emulator output.
+        # Read/dump the end of the emulator output; the full log can be huge.
+        logfile.seek(0, os.SEEK_END)
+        logfile.seek(max(0, logfile.tell() - EMULATOR_LOG_TAIL_BYTES))
         logging.info('*')
         logging.info('* Emulator Output')
-        logging.info('*\n%s', osutils.ReadFile(logfile.name))
+        logging.info('*\n%s', logfile.read())
         logging.info('*')
         logging.info('* Emulator End')
         logging.info('*')
@@ -152,7 +563,7 @@ class BrilloVmTestStage(BrilloStageBase):
     Returns:
       String containing the serial number of the emulator, or None
     """
-    result = self.RunLunchCommand(
+    result = self.RunLunchCommandNoShell(
         ['adb', 'devices'],
         redirect_stdout=True,
         combine_stdout_stderr=True)
@@ -165,12 +576,13 @@ class BrilloVmTestStage(BrilloStageBase):
     #   List of devices attached
     #   emulator-5554 device
 
-    m = re.search(r'^([\w-]+)\tdevice$', result.output, re.MULTILINE)
-    if m:
-      return m.group(1)
+    for line in result.output.splitlines():
+      serial, _, state = line.partition('\t')
+      if state == 'device':
+        return serial
     return None
 
-  def WaitForEmulatorSerial(self):
+  def PollForEmulatorSerial(self):
     """Retry the query for the emulator serial number, until it's ready.
 
     Returns:
@@ -187,21 +599,71 @@ class BrilloVmTestStage(BrilloStageBase):
 
     raise EmulatorNotReady()
 
-  def PerformStage(self):
-    """Run the VM Tests."""
-    with self.RunEmulator():
-      # To see the emulator, we must sometimes kill/restart the adb server.
-      self.RunLunchCommand(['adb', 'kill-server'])
+  def WaitForEmulatorSerial(self):
+    """Block until the emulator is ready, and return its serial number.
 
-      # Wait for the emulator to come up enough to give us a serial number.
-      serial = self.WaitForEmulatorSerial()
+    Returns:
+      String containing the serial number of the emulator.
+
+    Raises:
+      EmulatorNotReady if we timeout waiting (after several minutes).
+    """
+    try:
+      # adb returns as soon as a device reaches the 'device' state.
+      with timeout_util.Timeout(300):
+        self.RunLunchCommandNoShell(['adb', 'wait-for-device'])
+    except timeout_util.TimeoutError:
+      raise EmulatorNotReady()
+    except cros_build_lib.RunCommandError:
+      logging.warning('adb wait-for-device failed, falling back to polling.')
+      return self.PollForEmulatorSerial()
+
+    result = self.DiscoverEmulatorSerial()
+    if result:
+      return result
+
+    # adb saw a device, but not one we recognize; give it a little longer.
+    return self.PollForEmulatorSerial()
 
-      # Run the tests.
-      logging.info('Running tests against %s', serial)
-      self.RunLunchCommand(
-          ['external/autotest/site_utils/test_droid.py',
-           '--debug', '-s', serial, 'suite:brillo-smoke'],
-          cwd=self.BrilloRoot())
+  def PerformStage(self):
+    """Run the VM Tests."""
+    save_snapshot = (self.EmulatorSnapshotDir() and
+                     not self.EmulatorSnapshotSaved())
+
+    # To see the emulator, we must sometimes kill/restart the adb server. Kill
+    # it in the background while the emulator starts up. RunCommand can't be
+    # used from a thread (it installs signal handlers), so use Popen directly.
+    try:
+      adb_kill = subprocess.Popen(['adb', 'kill-server'], close_fds=True,
+                                  cwd=self.BrilloRoot(),
+                                  env=self._GetLunchEnv())
+    except OSError as e:
+      logging.warning('Unable to run adb kill-server: %s', e)
+      adb_kill = None
+
+    try:
+      with self.RunEmulator():
+        # The next adb command must start a fresh server, not find the old one.
+        if adb_kill:
+          adb_kill.wait()
+          adb_kill = None
+
+        # Wait for the emulator to come up enough to give us a serial number.
+        serial = self.WaitForEmulatorSerial()
+
+        # Capture the freshly booted state, before the tests change it.
+        if save_snapshot:
+          self.SaveEmulatorSnapshot(serial)
+
+        # Run the tests.
+        logging.info('Running tests against %s', serial)
+        self.RunLunchCommandNoShell(
+            ['external/autotest/site_utils/test_droid.py',
+             '--debug', '-s', serial, 'suite:brillo-smoke'],
+            cwd=self.BrilloRoot())
+    finally:
+      if adb_kill:
+        adb_kill.wait()
 
 
 class BrilloBuilder(generic_builders.Builder):
@@ -213,7 +675,15 @@ class BrilloBuilder(generic_builders.Builder):
 
   def RunStages(self):
     """Run something after sync/reexec."""
-    self._RunStage(BrilloCleanStage)
+    # The mirror is outside the checkout, so it can be fetched while we clean.
+    stages = [BrilloCleanStage]
+    if self._run.config.brillo_reference_mirror:
+      stages.append(BrilloMirrorSyncStage)
+    self._RunParallelStages([self._GetStageInstance(x) for x in stages])
+
+    self._RunStage(BrilloSnapshotRestoreStage)
     self._RunStage(BrilloSyncStage)
+    if self._run.config.brillo_snapshot_save:
+      self._RunStage(BrilloSnapshotSaveStage)
     self._RunStage(BrilloBuildStage)
     self._RunStage(BrilloVmTestStage)